@@ -1,8 +1,108 @@
 import genanki
+import hashlib
+import itertools
+import json
+import logging
 import random
 import os
+import secrets
+import shutil
+import sqlite3
+import time
+import zipfile
 from pathlib import Path
-from typing import List, Dict, Optional, Set
+from typing import List, Dict, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# .apkg 只是短期下载产物，默认用最快的 deflate 级别，压缩率与默认级别相差无几
+DEFAULT_COMPRESSION_LEVEL = 1
+
+# 这些格式本身已压缩，再做 deflate 只会白白消耗 CPU，直接以 ZIP_STORED 写入
+_PRECOMPRESSED_SUFFIXES = frozenset({
+    ".png", ".jpg", ".jpeg", ".gif", ".webp",
+    ".mp3", ".ogg", ".opus", ".m4a",
+    ".mp4", ".webm",
+})
+_MEDIA_COPY_BUFFER_SIZE = 1 << 20
+
+# 写入中的 .apkg 使用的后缀；进程崩溃遗留的此类文件由服务启动时清理
+PARTIAL_APKG_SUFFIX = ".apkg.tmp"
+# 以 0666 创建、由进程当前 umask 裁剪权限，与直接 open(path, "wb") 得到的权限一致
+_PARTIAL_OPEN_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0)
+
+
+class _TunedPackage(genanki.Package):
+    """
+    genanki.Package 的子类，允许指定 .apkg 的 deflate 压缩级别。
+    compression_level 为 0 时不压缩（ZIP_STORED，与 genanki 默认行为一致）。
+    """
+    def __init__(self, deck_or_decks=None, media_files=None,
+                 compression_level: int = DEFAULT_COMPRESSION_LEVEL):
+        super().__init__(deck_or_decks, media_files)
+        self.compression_level = compression_level
+
+    def _zip_options(self) -> Dict:
+        if self.compression_level <= 0:
+            return {"compression": zipfile.ZIP_STORED}
+        return {"compression": zipfile.ZIP_DEFLATED, "compresslevel": self.compression_level}
+
+    def _write_media(self, outzip: zipfile.ZipFile, path: str, arcname: str):
+        """
+        写入单个媒体文件。已压缩格式跳过 deflate，以 1 MiB 缓冲直接流式写入；
+        其他文件交给 ZipFile.write，沿用包级别的压缩级别。
+        """
+        if Path(path).suffix.lower() not in _PRECOMPRESSED_SUFFIXES:
+            outzip.write(path, arcname)
+            return
+
+        zinfo = zipfile.ZipInfo.from_file(path, arcname)
+        zinfo.compress_type = zipfile.ZIP_STORED
+        with open(path, "rb", buffering=_MEDIA_COPY_BUFFER_SIZE) as src, \
+                outzip.open(zinfo, "w") as dest:
+            shutil.copyfileobj(src, dest, _MEDIA_COPY_BUFFER_SIZE)
+
+    def write_to_file(self, file, timestamp: Optional[float] = None):
+        # 集合数据库直接在内存中构建并序列化写入 ZIP，省去临时文件的写入与回读
+        conn = sqlite3.connect(":memory:")
+        try:
+            cursor = conn.cursor()
+
+            if timestamp is None:
+                timestamp = time.time()
+
+            id_gen = itertools.count(int(timestamp * 1000))
+            self.write_to_db(cursor, timestamp, id_gen)
+
+            conn.commit()
+            collection = conn.serialize()
+        finally:
+            conn.close()
+
+        with zipfile.ZipFile(file, 'w', **self._zip_options()) as outzip:
+            outzip.writestr('collection.anki2', collection)
+
+            media_file_idx_to_path = dict(enumerate(self.media_files))
+            media_json = {idx: os.path.basename(path) for idx, path in media_file_idx_to_path.items()}
+            outzip.writestr('media', json.dumps(media_json))
+
+            for idx, path in media_file_idx_to_path.items():
+                self._write_media(outzip, path, str(idx))
+
+
+def _model_fingerprint(model_name: str, field_names: List[str],
+                       card_templates: List[Dict], model_css: str) -> str:
+    return json.dumps([model_name, field_names, card_templates, model_css],
+                      sort_keys=True, ensure_ascii=False)
+
+
+def _model_id(fingerprint: str) -> int:
+    """
+    由模型指纹哈希得出模型 ID（落在 [2^30, 2^31) 区间），因此同一笔记类型在多次导入间保持一致。
+    """
+    digest = hashlib.blake2b(fingerprint.encode("utf-8"), digest_size=4).digest()
+    return (int.from_bytes(digest, "big") & ((1 << 30) - 1)) | (1 << 30)
+
 
 class AnkiDeckCreator:
     """
@@ -21,10 +121,11 @@ class AnkiDeckCreator:
         self.card_templates = card_templates
         self.model_css = model_css
         self.sandbox_root = Path(sandbox_root).resolve() if sandbox_root else None
+        self._sandbox_root_str = str(self.sandbox_root) if self.sandbox_root else None
 
-        self._model_id = random.randrange(1 << 30, 1 << 31)
-        self._deck_id = random.randrange(1 << 30, 1 << 31)
-
+        self._model_id = _model_id(_model_fingerprint(
+            self.model_name, self.field_names, self.card_templates, self.model_css
+        ))
         self.model = genanki.Model(
             self._model_id,
             self.model_name,
@@ -32,67 +133,114 @@ class AnkiDeckCreator:
             templates=self.card_templates,
             css=self.model_css
         )
+        self._deck_id = random.randrange(1 << 30, 1 << 31)
 
         self.deck = genanki.Deck(self._deck_id, self.deck_name)
         self.media_files: Set[str] = set()
+        # 同一媒体常被多张笔记引用，按原始路径缓存解析结果，避免重复 stat
+        self._path_cache: Dict[str, Optional[Path]] = {}
 
     def _resolve_media_path(self, raw_path: str) -> Optional[Path]:
         """
         将媒体文件路径解析为绝对路径，并在启用沙盒时校验其不越界。
+        文件不存在时返回 None。
         """
-        candidate = Path(raw_path)
-        if not candidate.is_absolute():
-            base = self.sandbox_root or Path.cwd()
-            candidate = base / candidate
+        if raw_path in self._path_cache:
+            return self._path_cache[raw_path]
 
-        candidate = candidate.resolve(strict=False)
+        # 只做一次 realpath + 一次 stat；沙盒校验走字符串比较，不依赖异常分支
+        root = self._sandbox_root_str
+        candidate = raw_path
+        if not os.path.isabs(candidate):
+            candidate = os.path.join(root or os.getcwd(), candidate)
+        resolved = os.path.realpath(candidate)
 
-        if self.sandbox_root:
-            try:
-                candidate.relative_to(self.sandbox_root)
-            except ValueError as exc:
-                raise ValueError(f"媒体文件路径越过沙盒目录: {raw_path}") from exc
+        if root and os.path.commonpath((resolved, root)) != root:
+            raise ValueError(f"媒体文件路径越过沙盒目录: {raw_path}")
 
-        if not candidate.exists():
-            print(f"--> 警告: 媒体文件 '{raw_path}' 不存在，将不会被包含在内。")
-            return None
+        try:
+            os.stat(resolved)
+        except OSError:
+            # 与 Path.exists() 一致：不存在、权限不足、符号链接循环等都视为缺失，跳过该文件
+            candidate = None
+        else:
+            candidate = Path(resolved)
 
+        self._path_cache[raw_path] = candidate
         return candidate
 
     def add_note(self, field_data: List[str], media_paths: List[str] = None):
         """
         向牌组添加一张笔记。
         """
-        if len(field_data) != len(self.field_names):
-            raise ValueError(
-                f"Field data length mismatch. Expected {len(self.field_names)} fields, "
-                f"got {len(field_data)}. Data: {field_data}"
-            )
+        self.add_notes_bulk([(field_data, media_paths or [])])
 
-        note = genanki.Note(model=self.model, fields=field_data)
-        self.deck.add_note(note)
+    def add_notes_bulk(self, notes: List[Tuple[List[str], List[str]]]):
+        """
+        批量向牌组添加笔记。每一项为 (field_data, media_paths)。
+        先整体校验字段数量并解析全部媒体路径，全部通过后再一次性写入牌组，
+        避免出现只添加了一部分笔记或媒体的情况。
+        """
+        expected = len(self.field_names)
+        for field_data, _ in notes:
+            if len(field_data) != expected:
+                raise ValueError(
+                    f"Field data length mismatch. Expected {expected} fields, "
+                    f"got {len(field_data)}. Data: {field_data}"
+                )
 
-        if media_paths:
-            for path in media_paths:
-                # 关键的检查点：服务器/脚本能否找到这个路径
-                print(f"正在检查媒体文件路径: '{path}'")
+        debug = logger.isEnabledFor(logging.DEBUG)
+        found: List[str] = []
+        missing: Dict[str, None] = {}
+        for _, media_paths in notes:
+            for path in media_paths or []:
+                # 关键的检查点：服务器/脚本能否找到这个路径（越界时抛出 ValueError）
                 resolved = self._resolve_media_path(path)
                 if not resolved:
+                    missing[path] = None
                     continue
-                print(f"--> 成功: 找到文件 '{resolved}'，将添加到卡组包。")
-                self.media_files.add(str(resolved))
+                if debug:
+                    logger.debug("找到媒体文件 '%s' -> '%s'，将添加到卡组包。", path, resolved)
+                found.append(str(resolved))
 
-    def finalize_and_save(self, output_filename: str) -> str:
+        model = self.model
+        self.deck.notes.extend([
+            genanki.Note(model=model, fields=field_data)
+            for field_data, _ in notes
+        ])
+        self.media_files.update(found)
+
+        if missing:
+            logger.warning(
+                "%d 个媒体文件不存在，将不会被包含在内: %s",
+                len(missing), ", ".join(missing),
+            )
+
+    def finalize_and_save(self, output_filename: str,
+                          compression_level: int = DEFAULT_COMPRESSION_LEVEL) -> str:
         """
         完成牌组创建并将牌组及其媒体文件保存为 .apkg 文件。
         """
-        package = genanki.Package(self.deck)
+        package = _TunedPackage(self.deck, compression_level=compression_level)
         package.media_files = list(self.media_files)
 
+        # 先写到目标目录下的临时文件再 os.replace：同一文件系统内的重命名只改元数据，
+        # 且下载目录中不会出现写了一半的 .apkg
+        output_path = os.path.abspath(output_filename)
+        tmp_path = os.path.join(
+            os.path.dirname(output_path), secrets.token_hex(8) + PARTIAL_APKG_SUFFIX
+        )
+        fd = os.open(tmp_path, _PARTIAL_OPEN_FLAGS, 0o666)
         try:
-            package.write_to_file(output_filename)
-            return os.path.abspath(output_filename)
+            with os.fdopen(fd, "wb") as tmp_file:
+                package.write_to_file(tmp_file)
+            os.replace(tmp_path, output_path)
+            return output_path
         except Exception as e:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
             raise IOError(f"Failed to save Anki package to {output_filename}: {e}")
 
 
@@ -104,7 +252,8 @@ def create_anki_deck_package(
     notes_data: List[Dict],
     output_filename: str,
     model_css: str = "",
-    sandbox_root: Optional[Path] = None
+    sandbox_root: Optional[Path] = None,
+    compression_level: int = DEFAULT_COMPRESSION_LEVEL
 ) -> str:
     """
     创建一个 Anki 牌组，添加多张笔记，并将其保存为 .apkg 文件。
@@ -118,12 +267,12 @@ def create_anki_deck_package(
         sandbox_root=sandbox_root,
     )
 
-    for note_item in notes_data:
-        field_data = note_item.get("field_data")
-        media_paths = note_item.get("media_paths", [])
-        creator.add_note(field_data, media_paths)
+    creator.add_notes_bulk([
+        (note_item.get("field_data"), note_item.get("media_paths", []))
+        for note_item in notes_data
+    ])
 
-    return creator.finalize_and_save(output_filename)
+    return creator.finalize_and_save(output_filename, compression_level=compression_level)
 
 
 # ==============================================================================
@@ -1,5 +1,5 @@
 from typing import List, Optional
-from pydantic import BaseModel, Field, AnyHttpUrl
+from pydantic import BaseModel, Field, field_validator
 import platform
 
 
@@ -38,8 +38,22 @@ class CreateDeckRequest(BaseModel):
                                       {"field_data": ["Capital of France?", "Paris", ""], "media_paths": []}
                                   ]''')
     model_css: Optional[str] = Field(default="",description="应用于所有卡片的 CSS 样式。默认为空字符串") 
+    compression_level: int = Field(
+        default=1,
+        ge=0,
+        le=9,
+        description="生成 .apkg 时的 deflate 压缩级别（0-9）。0 表示不压缩，1 最快，9 压缩率最高。默认为 1",
+    )
 
 
 class CreateDeckResult(BaseModel):
     status: str
-    download_url: AnyHttpUrl
+    download_url: str
+
+    @field_validator("download_url")
+    @classmethod
+    def _check_download_url(cls, url: str) -> str:
+        # 链接由服务器自行拼接，只需确认协议前缀，无需完整解析 URL
+        if not url.startswith(("http://", "https://")):
+            raise ValueError(f"下载链接必须以 http:// 或 https:// 开头: {url}")
+        return url
@@ -1,5 +1,6 @@
 import os
-import uuid
+import hmac
+import secrets
 import asyncio
 from pathlib import Path
 from typing import Any
@@ -12,7 +13,7 @@ from starlette.staticfiles import StaticFiles
 import uvicorn
 
 from .anki_models import CreateDeckRequest, CreateDeckResult
-from anki_tools.genanki_tool import create_anki_deck_package
+from anki_tools.genanki_tool import PARTIAL_APKG_SUFFIX, create_anki_deck_package
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -22,10 +23,16 @@ PORT = int(os.environ.get('PORT', 10093))
 SREVERIP = os.environ.get('SREVERIP', "127.0.0.1")
 HOST = "0.0.0.0"
 SANDBOX_ROOT = Path(__file__).resolve().parents[1]
+SANDBOX_ROOT_STR = str(SANDBOX_ROOT)
+SANDBOX_ROOT_PREFIX = SANDBOX_ROOT_STR.rstrip(os.sep) + os.sep  # 用于前缀判断，避免 /root/pkg2 误匹配 /root/pkg
 TEMP_DOWNLOAD_DIR = SANDBOX_ROOT / "temp_anki_decks"
+TEMP_DOWNLOAD_DIR_STR = str(TEMP_DOWNLOAD_DIR)
 DOWNLOAD_PATH = "/downloads"
 DOWNLOAD_EXPIRATION_SECONDS = 600
 API_TOKEN = os.environ.get('TOKEN', '')  # 从环境变量加载TOKEN
+API_TOKEN_BYTES = API_TOKEN.encode()
+_AUTH_DISABLED = not API_TOKEN
+MEDIA_RESOLVE_CONCURRENCY = 32  # 并发解析媒体路径的最大线程数
 
 # --- MCP-Server-Initialisierung ---
 mcp = FastMCP(
@@ -42,6 +49,11 @@ async def lifespan(app: Starlette):
     管理 MCP 服务器的生命周期。
     这对于初始化 MCP 的后台任务至关重要。
     """
+    # 下载目录只需在启动时创建一次，请求路径上不再重复 mkdir
+    os.makedirs(TEMP_DOWNLOAD_DIR_STR, exist_ok=True)
+    # 清理上次进程在写包途中退出遗留的临时文件
+    for stale in TEMP_DOWNLOAD_DIR.glob(f"*{PARTIAL_APKG_SUFFIX}"):
+        _delete_temp_file(stale)
     async with mcp.session_manager.run():
         print("MCP Session Manager started.")
         yield
@@ -53,43 +65,30 @@ def verify_token(ctx: Context) -> bool:
     """
     验证请求的Authorization头中的令牌是否有效
     """
-    if not API_TOKEN:  # 如果未设置API_TOKEN，则不进行验证
+    if _AUTH_DISABLED:  # 如果未设置API_TOKEN，则不进行验证
         return True
-    
-    # 获取请求头信息 - 尝试不同的方式获取Authorization头
-    headers = {}
-    
-    # 1. 尝试从meta中获取
-    meta = ctx.request_context.meta
-    if meta and hasattr(meta, 'get'):
-        # 尝试小写和大写版本
-        auth_header = meta.get('authorization', '') or meta.get('Authorization', '')
-        if auth_header:
-            headers['Authorization'] = auth_header
-    
-    # 2. 尝试从request的headers属性获取
-    if not headers.get('Authorization') and hasattr(ctx.request_context, 'request'):
-        request = ctx.request_context.request
-        if hasattr(request, 'headers'):
-            # 尝试小写和大写版本
-            auth_header = request.headers.get('authorization', '') or request.headers.get('Authorization', '')
-            if auth_header:
-                headers['Authorization'] = auth_header
-    
-    # 检查是否找到Authorization头
-    auth_header = headers.get('Authorization', '')
-    
+
+    # 优先从 HTTP 请求头获取（Starlette 的 Headers 本身大小写不敏感），其次回退到 meta
+    request = getattr(ctx.request_context, "request", None)
+    auth_header = getattr(request, "headers", {}).get("authorization", "")
+    if not auth_header:
+        meta = ctx.request_context.meta
+        if meta and hasattr(meta, 'get'):
+            auth_header = meta.get('authorization', '') or meta.get('Authorization', '')
+
     # 检查格式为 "Bearer <token>"
-    if not auth_header.startswith('Bearer '):
+    auth_bytes = auth_header.encode()
+    if not auth_bytes.startswith(b'Bearer '):
         print(f"认证失败: 无效的Authorization头格式 - {auth_header[:10]}...")
         return False
-    
-    token = auth_header.split('Bearer ')[1].strip()
-    result = token == API_TOKEN
-    
+
+    token_bytes = auth_bytes[len(b'Bearer '):].strip()
+    # 常量时间比较，避免通过响应耗时推测令牌
+    result = hmac.compare_digest(token_bytes, API_TOKEN_BYTES)
+
     if not result:
-        print(f"认证失败: 令牌不匹配 - 收到的令牌前几位: {token[:3]}...")
-    
+        print(f"认证失败: 令牌不匹配 - 收到的令牌前几位: {token_bytes[:3].decode(errors='replace')}...")
+
     return result
 
 
@@ -97,20 +96,46 @@ def _resolve_within_sandbox(raw_path: str | Path, *, require_exists: bool = True
     """
     将传入路径解析为沙盒内的绝对路径，默认要求该路径存在。
     """
-    candidate = Path(raw_path)
-    if not candidate.is_absolute():
-        candidate = SANDBOX_ROOT / candidate
-    candidate = candidate.resolve(strict=False)
+    # 全程使用字符串路径，只在返回时构造一次 Path
+    raw = os.fspath(raw_path)
+    resolved = os.path.realpath(raw if os.path.isabs(raw) else os.path.join(SANDBOX_ROOT_STR, raw))
 
-    try:
-        candidate.relative_to(SANDBOX_ROOT)
-    except ValueError as exc:
-        raise ValueError(f"路径不允许越过沙盒目录: {raw_path}") from exc
+    if resolved != SANDBOX_ROOT_STR and not resolved.startswith(SANDBOX_ROOT_PREFIX):
+        raise ValueError(f"路径不允许越过沙盒目录: {raw_path}")
 
-    if require_exists and not candidate.exists():
+    if require_exists and not os.path.exists(resolved):
         raise ValueError(f"路径不存在或不可访问: {raw_path}")
 
-    return candidate
+    return Path(resolved)
+
+
+def _delete_temp_file(path: Path | str) -> None:
+    """
+    删除过期的临时牌组文件，文件已不存在时静默忽略。
+    """
+    try:
+        path = _resolve_within_sandbox(path, require_exists=False)
+        os.unlink(path)
+        print(f"成功删除临时文件: {path}")
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        print(f"删除临时文件 {path} 时出错: {e}")
+
+
+async def _resolve_media_paths(raw_paths: list[str]) -> dict[str, str]:
+    """
+    在线程池中并发解析一组媒体路径，返回 原始路径 -> 沙盒内绝对路径 的映射。
+    任一路径非法或不存在时抛出 ValueError。
+    """
+    semaphore = asyncio.Semaphore(MEDIA_RESOLVE_CONCURRENCY)
+
+    async def resolve(path: str) -> str:
+        async with semaphore:
+            return str(await asyncio.to_thread(_resolve_within_sandbox, path))
+
+    resolved = await asyncio.gather(*(resolve(path) for path in raw_paths))
+    return dict(zip(raw_paths, resolved))
 
 
 @mcp.tool()
@@ -136,54 +161,49 @@ async def create_anki_deck(req: CreateDeckRequest, ctx: Context) -> CreateDeckRe
         raise ValueError("认证失败：无效的访问令牌")
     
     # 1. 生成唯一的文件名和路径
-    unique_filename = f"{uuid.uuid4()}.apkg"
-    # 确保临时目录存在
-    TEMP_DOWNLOAD_DIR.mkdir(parents=True, exist_ok=True)
-    output_filepath = TEMP_DOWNLOAD_DIR / unique_filename
+    unique_filename = secrets.token_urlsafe(16) + ".apkg"
+    output_filepath = os.path.join(TEMP_DOWNLOAD_DIR_STR, unique_filename)
     
     # 2. 转换模型以适应工具函数
-    templates = [t.model_dump() for t in req.card_templates]
-    sanitized_notes = []
-    for note in req.notes_data:
-        sanitized_media = [
-            str(_resolve_within_sandbox(path))
-            for path in (note.media_paths or [])
-        ]
-        sanitized_notes.append(
-            {
-                "field_data": note.field_data,
-                "media_paths": sanitized_media,
-            }
-        )
-
-    # 3. 创建牌组包
-    create_anki_deck_package(
+    # 直接构造 genanki 所需的字典，比逐个 model_dump 省去序列化器开销
+    templates = [{"name": t.name, "qfmt": t.qfmt, "afmt": t.afmt} for t in req.card_templates]
+    # 同一请求内相同的媒体路径只解析一次
+    unique_media = list(dict.fromkeys(
+        path for note in req.notes_data for path in (note.media_paths or [])
+    ))
+    resolved_media = await _resolve_media_paths(unique_media)
+    sanitized_notes = [
+        {
+            "field_data": note.field_data,
+            "media_paths": [resolved_media[path] for path in (note.media_paths or [])],
+        }
+        for note in req.notes_data
+    ]
+
+    # 3. 创建牌组包（CPU/IO 密集，放到线程中执行以免阻塞事件循环）
+    await asyncio.to_thread(
+        create_anki_deck_package,
         deck_name=req.deck_name,
         model_name=req.model_name,
         field_names=req.field_names,
         card_templates=templates,
         notes_data=sanitized_notes,
-        output_filename=str(output_filepath),
+        output_filename=output_filepath,
         model_css=req.model_css or "",
         sandbox_root=SANDBOX_ROOT,
+        compression_level=req.compression_level,
     )
 
     # 4. 创建下载链接
     server_port = ctx.fastmcp.settings.port
     download_url = f"http://{SREVERIP}:{server_port}{DOWNLOAD_PATH}/{unique_filename}"
 
-    # 5. 定义并调度清理任务
-    async def delete_file_after_delay(path: Path | str, delay: int):
-        await asyncio.sleep(delay)
-        try:
-            path = _resolve_within_sandbox(path, require_exists=False)
-            if path.exists():
-                path.unlink()
-            print(f"成功删除临时文件: {path}")
-        except (OSError, ValueError) as e:
-            print(f"删除临时文件 {path} 时出错: {e}")
-
-    asyncio.create_task(delete_file_after_delay(output_filepath, DOWNLOAD_EXPIRATION_SECONDS))
+    # 5. 调度清理：到期后在线程池中删除临时文件
+    loop = asyncio.get_running_loop()
+    loop.call_later(
+        DOWNLOAD_EXPIRATION_SECONDS,
+        loop.run_in_executor, None, _delete_temp_file, output_filepath,
+    )
 
     # 6. 返回结果
     return CreateDeckResult(status="success", download_url=download_url)
@@ -192,7 +212,7 @@ async def create_anki_deck(req: CreateDeckRequest, ctx: Context) -> CreateDeckRe
 # --- 主应用设置 ---
 app = Starlette(
     routes=[
-        Mount(DOWNLOAD_PATH, app=StaticFiles(directory=str(TEMP_DOWNLOAD_DIR)), name="downloads"),
+        Mount(DOWNLOAD_PATH, app=StaticFiles(directory=TEMP_DOWNLOAD_DIR_STR, check_dir=False), name="downloads"),
         Mount("/", app=mcp.streamable_http_app()),
     ],
     lifespan=lifespan  # <-- 关键：将生命周期管理器附加到应用